@@ -1,15 +1,19 @@
 import webview
 import socket
 import datetime
+import json
 import os
+import queue
+import re
 import sys
 import threading
 import time
 import tempfile
 import atexit
+from dataclasses import dataclass
 
 from calibration import CalibrationStore
-from units import UnitStore, UNIT_GROUPS
+from units import UnitStore
 
 # Platform-specific imports for file locking
 if sys.platform == "win32":
@@ -18,6 +22,54 @@ else:
     import fcntl
 
 
+# Channel line of a TDS530 reply: M%03d  %lf
+_LINE_RE = re.compile(rb"^M\d{3}  ([^\r\n]*)", re.MULTILINE)
+
+
+@dataclass(slots=True)
+class Sample:
+    """One parsed TDS530 reply: timestamp and raw channel values."""
+    time: datetime.datetime
+    data: list[float | None]
+
+
+@dataclass(slots=True)
+class CalibratedSample:
+    """A sample as stored by TDS530Api, with physical values and formatted time."""
+    time: datetime.datetime
+    time_str: str
+    raw: list[float | None]
+    physical: list[float | None]
+
+
+def parse_frame(buf: bytes) -> Sample:
+    """
+    Parse one TDS530 reply to an "ST" request.
+    1st line (time): YYYY/MM/DD HH:MM:SS
+    Following lines (1ch data each): M%03d  %lf
+    Returns a Sample whose data holds one float per channel, or None for a
+    channel that could not be parsed.
+    Raises ValueError if the time line is malformed or no channel is found.
+    """
+    t = datetime.datetime(
+        int(buf[0:4]), int(buf[5:7]), int(buf[8:10]),
+        int(buf[11:13]), int(buf[14:16]), int(buf[17:19]))
+
+    val_strs = _LINE_RE.findall(buf)
+    if not val_strs:
+        raise ValueError("No channel data in reply")
+    try:
+        values = [float(v) for v in val_strs]
+    except ValueError:
+        values = []
+        for v in val_strs:
+            try:
+                values.append(float(v))
+            except ValueError:
+                values.append(None)
+    return Sample(t, values)
+
+
 class SingleInstanceLock:
     """
     Prevents multiple instances of the application from running simultaneously.
@@ -91,93 +143,120 @@ class SingleInstanceLock:
 
 class TDS530DataCollector:
     """Thread-based TCP data collector for TDS530 device."""
+
+    # Seconds allowed for connect(); shutdown()/close() cannot interrupt it
+    CONNECT_TIMEOUT = 2.0
+    # Seconds to wait for the thread to exit; covers a pending connect() plus cleanup
+    STOP_JOIN_TIMEOUT = CONNECT_TIMEOUT + 1.0
+    # Seconds from sending "ST" until the whole reply must have arrived
+    FRAME_TIMEOUT = 5.0
+    # Kernel receive buffer requested for the device socket
+    RCVBUF_SIZE = 1 << 20
+    # Userspace read size; large enough for a full "ST" reply in one recv
+    READ_BUFFER_SIZE = 1 << 16
     
     def __init__(self, host: str, port: int, recv_callback=None):
         self.host = host
         self.port = port
         self.recv_callback = recv_callback
         self._running = False
+        self._stop_event = threading.Event()
         self._thread: threading.Thread | None = None
         self._socket: socket.socket | None = None
     
-    def start(self):
-        """Start the data collection thread."""
+    def start(self) -> bool:
+        """
+        Start the data collection thread.
+        Returns True if the collector is running, False if a previous
+        thread could not be stopped (two threads must never share the socket).
+        """
         if self._running:
-            return
+            return True
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=self.STOP_JOIN_TIMEOUT)
+            if self._thread.is_alive():
+                return False
         self._running = True
+        self._stop_event.clear()
         self._thread = threading.Thread(target=self._run, daemon=True)
         self._thread.start()
+        return True
     
     def stop(self):
         """Stop the data collection thread."""
         self._running = False
-        if self._socket:
+        self._stop_event.set()
+        sock = self._socket
+        if sock:
+            try:
+                # Wake up a readline() blocked in the collector thread
+                sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
             try:
-                self._socket.close()
+                sock.close()
             except Exception:
                 pass
         if self._thread and self._thread.is_alive():
-            self._thread.join(timeout=2.0)
+            # A pending connect() is only bounded by its own timeout
+            self._thread.join(timeout=self.STOP_JOIN_TIMEOUT)
     
     def _run(self):
         """Main data collection loop running in a separate thread."""
         while self._running:
+            rfile = None
             try:
                 self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self._socket.settimeout(2.0)
+                # Set before connect so the window scale is negotiated for it
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF_SIZE)
+                self._socket.settimeout(self.CONNECT_TIMEOUT)
                 self._socket.connect((self.host, self.port))
+                # Each "ST" request is a tiny write awaiting a reply: disable Nagle
+                self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                # A timeout leaves rfile unusable, so it always means reconnect
+                rfile = self._socket.makefile("rb", buffering=self.READ_BUFFER_SIZE)
                 
                 while self._running:
-                    ret: dict = {}
                     request_message = "ST\r\n"
                     self._socket.sendall(request_message.encode("utf-8"))
                     
-                    received_buffer = ""
-                    terminator = "END       "  # "END" + 7 spaces + newline
+                    deadline = time.monotonic() + self.FRAME_TIMEOUT
                     
-                    while self._running:
-                        try:
-                            chunk = self._socket.recv(1024)
-                        except socket.timeout:
-                            continue
-                        except Exception:
-                            break
+                    received_buffer = bytearray()
+                    terminator = b"END       "  # "END" + 7 spaces + newline
+                    scan_from = 0
+                    end = -1
+                    
+                    while True:
+                        # read1() makes at most one recv(), so bounding each one by
+                        # the time left keeps a trickling device within the deadline
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise socket.timeout("Reply not complete within FRAME_TIMEOUT.")
+                        self._socket.settimeout(remaining)
+                        chunk = rfile.read1(self.READ_BUFFER_SIZE)
                         if not chunk:
                             raise ConnectionError("Disconnected by server.")
-                        text_chunk = chunk.decode("utf-8", errors="replace")
-                        received_buffer += text_chunk
-                        if terminator in received_buffer:
+                        received_buffer += chunk
+                        # Only scan the new bytes (plus overlap for a split terminator)
+                        if end == -1:
+                            end = received_buffer.find(terminator, scan_from)
+                            scan_from = max(0, len(received_buffer) - len(terminator))
+                        if end != -1 and received_buffer.find(b"\n", end) != -1:
                             break
                     
                     if not self._running:
                         break
                     
-                    # Parse received data:
-                    # 1st(time): YYYY/MM/DD HH:MM:SS
-                    # 2nd (1ch data): M%03d  %lf
-                    lines = received_buffer.splitlines()
-                    if len(lines) < 2:
-                        continue
-                    
                     try:
-                        ret["time"] = datetime.datetime.strptime(lines[0], "%Y/%m/%d %H:%M:%S")
+                        sample = parse_frame(received_buffer)
                     except ValueError:
                         continue
                     
-                    ret["data"] = []
-                    for line in lines[1:]:
-                        parts = line.split("  ")
-                        if len(parts) == 2:
-                            _, val_str = parts
-                            try:
-                                val = float(val_str)
-                                ret["data"].append(val)
-                            except ValueError:
-                                ret["data"].append(None)
-                    
                     if self.recv_callback is not None:
-                        self.recv_callback(ret)
-                    time.sleep(0.1)
+                        self.recv_callback(sample)
+                    if self._stop_event.wait(0.1):
+                        break
                 
             except (ConnectionRefusedError, socket.timeout, OSError):
                 # Connection failed, retry after delay
@@ -185,6 +264,11 @@ class TDS530DataCollector:
             except Exception:
                 pass
             finally:
+                if rfile is not None:
+                    try:
+                        rfile.close()
+                    except Exception:
+                        pass
                 if self._socket:
                     try:
                         self._socket.close()
@@ -192,41 +276,112 @@ class TDS530DataCollector:
                         pass
                     self._socket = None
             
-            # Wait before retry if still running
-            if self._running:
-                time.sleep(1.0)
+            # Wait before retry unless stop() is called meanwhile
+            if self._stop_event.wait(1.0):
+                break
 
 
 class TDS530Api:
     """API class exposed to JavaScript via pywebview."""
+
+    # Number of samples written between explicit flushes of the save file
+    FLUSH_INTERVAL = 50
+    # Samples buffered for the writer thread before new ones are dropped
+    WRITE_QUEUE_SIZE = 1024
     
     def __init__(self, calibration: CalibrationStore, units: UnitStore):
         self.calibration = calibration
         self.units = units
-        self.latest_data: dict = {}
+        self.latest_data: CalibratedSample | None = None
+        # JSON-ready view of latest_data, shared by get_latest_data and the UI push
+        self._latest_view: dict | None = None
         self._lock = threading.Lock()
         self._save_file = None
-        self._header_written = False
+        self._write_q: queue.Queue | None = None
+        self._writer: threading.Thread | None = None
+        # UI push thread: woken when the device timestamp changes, sends _latest_view
+        self._ui_event = threading.Event()
+        self._ui_stop = threading.Event()
+        self._ui_thread: threading.Thread | None = None
+        self._last_push_time: str | None = None
 
-    def update_data(self, data: dict):
+    def update_data(self, data: Sample):
         """Called by the data collector when new data is received."""
+        stored = CalibratedSample(
+            time=data.time,
+            time_str=self._format_time(data.time),
+            raw=data.data,
+            physical=self.calibration.apply(data.data),
+        )
+        view = {
+            "time": stored.time_str,
+            "raw": stored.raw,
+            "physical": stored.physical,
+        }
         with self._lock:
-            raw_data = data["data"]
-            physical_data = self.calibration.apply(raw_data)
-            stored = {
-                "time": data["time"],
-                "raw": raw_data,
-                "physical": physical_data,
-            }
             self.latest_data = stored
-
-            # Save to file if saving is enabled
-            if self._save_file is not None:
+            self._latest_view = view
+            # Enqueue under the lock (non-blocking) so stop_saving's sentinel
+            # can never slip in ahead of this sample; done before the UI push
+            if self._write_q is not None:
                 try:
-                    self._write_data_to_file(stored)
-                except Exception:
+                    self._write_q.put_nowait(stored)
+                except queue.Full:
                     pass
 
+        # The device clock has 1 s resolution; only wake the UI push on a new timestamp
+        if stored.time_str != self._last_push_time:
+            self._last_push_time = stored.time_str
+            self._ui_event.set()
+
+    def start_ui_push(self):
+        """
+        Start the thread that pushes new samples to the frontend.
+        Any previous push thread is stopped; it gets its own events, so if it
+        is still blocked in run_js it exits on its own without affecting the new one.
+        """
+        self.stop_ui_push()
+        self._ui_event = threading.Event()
+        self._ui_stop = threading.Event()
+        self._ui_thread = threading.Thread(
+            target=self._ui_push_loop,
+            args=(self._ui_event, self._ui_stop),
+            daemon=True)
+        self._ui_thread.start()
+
+    def stop_ui_push(self):
+        """Stop the UI push thread without waiting (it may be blocked in run_js)."""
+        self._ui_stop.set()
+        self._ui_event.set()
+
+    def _ui_push_loop(self, wake: threading.Event, stop: threading.Event):
+        """Push the latest view each time update_data signals a new timestamp."""
+        while True:
+            wake.wait()
+            wake.clear()
+            if stop.is_set():
+                break
+            with self._lock:
+                view = self._latest_view
+            if view is not None:
+                self._push_to_ui(view)
+
+    def _push_to_ui(self, view: dict):
+        """Push a sample to the frontend; run_js blocks until the UI thread runs it."""
+        if not webview.windows:
+            return
+        payload = json.dumps(view)
+        try:
+            webview.windows[0].run_js(
+                f"window.onTDS530Data && window.onTDS530Data({payload})")
+        except Exception:
+            pass
+
+    @staticmethod
+    def _format_time(t: datetime.datetime) -> str:
+        """Format time as YYYY/MM/DD HH:MM:SS without going through strftime."""
+        return f"{t.year:04}/{t.month:02}/{t.day:02} {t.hour:02}:{t.minute:02}:{t.second:02}"
+
     @staticmethod
     def _format_raw_value(value):
         """Format raw value like the reference TSV (integer when whole)."""
@@ -243,40 +398,49 @@ class TDS530Api:
             return ""
         return f"{value:.3f}"
 
-    def _write_data_to_file(self, data: dict):
+    @staticmethod
+    def _build_header(raw_count: int, phy_count: int) -> str:
+        """Build the TSV header line for the given channel counts."""
+        header_parts = ["timestamp"]
+        header_parts += [f"ai_raw_{idx:02d}" for idx in range(raw_count)]
+        header_parts += [f"ai_phy_{idx:02d}" for idx in range(phy_count)]
+        return "\t".join(header_parts) + "\n"
+
+    def _write_data_to_file(self, f, data: CalibratedSample):
         """Write raw and physical data to TSV file."""
-        if self._save_file is None:
-            return
+        f.write(data.time_str)
+        f.write(".000\t")
+        f.write("\t".join(map(self._format_raw_value, data.raw)))
+        f.write("\t")
+        f.write("\t".join(map(self._format_phy_value, data.physical)))
+        f.write("\n")
 
-        if not self._header_written:
-            header_parts = ["timestamp"]
-            for idx in range(len(data["raw"])):
-                header_parts.append(f"ai_raw_{idx:02d}")
-            for idx in range(len(data["physical"])):
-                header_parts.append(f"ai_phy_{idx:02d}")
-            self._save_file.write("\t".join(header_parts) + "\n")
-            self._header_written = True
-
-        time_str = data["time"].strftime("%Y/%m/%d %H:%M:%S") + ".000"
-        data_strs = [time_str]
-        for raw in data["raw"]:
-            data_strs.append(self._format_raw_value(raw))
-        for phy in data["physical"]:
-            data_strs.append(self._format_phy_value(phy))
-        line = "\t".join(data_strs) + "\n"
-        self._save_file.write(line)
-        self._save_file.flush()
+    def _writer_loop(self, f, write_q: queue.Queue):
+        """Drain queued samples into the save file until a None sentinel arrives."""
+        header_written = False
+        unflushed = 0
+        while True:
+            data = write_q.get()
+            if data is None:
+                break
+            try:
+                if not header_written:
+                    f.write(self._build_header(len(data.raw), len(data.physical)))
+                    header_written = True
+                self._write_data_to_file(f, data)
+                unflushed += 1
+                if unflushed >= self.FLUSH_INTERVAL:
+                    f.flush()
+                    unflushed = 0
+            except Exception:
+                pass
     
     def get_latest_data(self):
         """Get latest raw and physical data - called from JavaScript."""
         with self._lock:
-            if not self.latest_data:
+            if self._latest_view is None:
                 return {"error": "No data available"}
-            return {
-                "time": self.latest_data["time"].strftime("%Y/%m/%d %H:%M:%S"),
-                "raw": self.latest_data["raw"],
-                "physical": self.latest_data["physical"]
-            }
+            return self._latest_view
     
     def get_calibration(self):
         """Get calibration for frontend: group a,b + per-channel c."""
@@ -314,9 +478,9 @@ class TDS530Api:
         try:
             ch_index = int(ch)
             with self._lock:
-                if not self.latest_data:
+                if self.latest_data is None:
                     return {"error": "No data available"}
-                raw_list = self.latest_data.get("raw", [])
+                raw_list = self.latest_data.raw
                 if ch_index >= len(raw_list) or raw_list[ch_index] is None:
                     return {"error": "Channel data not available"}
                 raw_val = raw_list[ch_index]
@@ -346,27 +510,37 @@ class TDS530Api:
                 return {"error": "Already saving"}
             
             try:
-                self._save_file = open(filepath, "w", encoding="utf-8")
-                self._header_written = False
-                return {"success": True, "filepath": filepath}
+                self._save_file = open(filepath, "w", encoding="utf-8", buffering=1 << 16)
             except Exception as e:
                 return {"error": str(e)}
+
+            self._write_q = queue.Queue(maxsize=self.WRITE_QUEUE_SIZE)
+            self._writer = threading.Thread(
+                target=self._writer_loop,
+                args=(self._save_file, self._write_q),
+                daemon=True)
+            self._writer.start()
+            return {"success": True, "filepath": filepath}
     
     def stop_saving(self):
         """Stop saving data - called from JavaScript."""
         with self._lock:
             if self._save_file is None:
                 return {"error": "Not saving"}
-            
-            try:
-                self._save_file.close()
-            except Exception:
-                pass
-            finally:
-                self._save_file = None
-                self._header_written = False
-            
-            return {"success": True}
+            save_file, write_q, writer = self._save_file, self._write_q, self._writer
+            self._save_file = None
+            self._write_q = None
+            self._writer = None
+
+        # Let the writer drain pending samples outside the lock
+        write_q.put(None)
+        writer.join()
+        try:
+            save_file.close()
+        except Exception:
+            pass
+        
+        return {"success": True}
     
     def is_saving(self):
         """Check if currently saving - called from JavaScript."""
@@ -444,10 +618,15 @@ if __name__ == "__main__":
 
     # Start data collector when window is ready
     def on_loaded():
-        collector.start()
+        api.start_ui_push()
+        if not collector.start():
+            print("Data collector is still shutting down; not started.", file=sys.stderr)
     
     def on_closed():
+        api.stop_ui_push()
         collector.stop()
+        if api.is_saving():
+            api.stop_saving()
         instance_lock.release()
     
     window.events.loaded += on_loaded